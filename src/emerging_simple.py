@@ -5,13 +5,14 @@ Emerging hotspot (simple): compare recent vs baseline windows on H3 hex weekly c
 Input
 -----
 `data/processed/hex_week.{parquet|csv}` with columns:
-    - h3          : H3 cell id
+    - h3          : H3 cell id (hex string or its integer form)
     - week_start  : week start (datetime)
     - count       : weekly incident count
 
 Output
 ------
 `geojson/emerging.geojson` (each feature has a `label` ∈ {"New","Intensifying","Persistent"} and metrics)
+`--format fgb|parquet` writes FlatGeobuf / GeoParquet (GeoArrow) next to it instead.
 
 Usage
 -----
@@ -20,173 +21,169 @@ python src/emerging_simple.py \
   --out geojson/emerging.geojson \
   --baseline_weeks 12 --recent_weeks 4 \
   --z_thresh 1.0 --new_min_recent 2 --include_unlabeled 0
+
+In-process (e.g. from a pipeline script, without paying the imports again):
+    import emerging_simple
+    emerging_simple.cli(["--hex_week", "data/processed/hex_week.parquet"])
 """
 
 import argparse
-from pathlib import Path
 import numpy as np
 import pandas as pd
 
+__all__ = ["main", "cli"]
+
+try:
+    import polars as pl
+except ImportError:
+    raise SystemExit("polars required. Install via conda-forge.")
+
 try:
     import geopandas as gpd
-    from shapely.geometry import Polygon
+    import shapely
 except Exception:
     raise SystemExit("geopandas + shapely required. Install via conda-forge.")
-try:
-    import h3
-except ImportError:
-    raise SystemExit("h3-py (v3 or v4) required.")
-
-# --- H3 v3/v4 boundary helper (returns list of (lon, lat)) ---
-def h3_boundary_lonlat(h):
-    if hasattr(h3, "h3_to_geo_boundary"):  # v3
-        return h3.h3_to_geo_boundary(h, geo_json=True)
-    pts = h3.cell_to_boundary(h)          # v4: (lat, lon)
-    return [(lon, lat) for (lat, lon) in pts]
-
-def read_hex_week(path: str) -> pd.DataFrame:
-    """Read parquet/csv; normalize column names & convert week_start to Toronto tz."""
-    path = str(path)
-    if path.lower().endswith(".parquet"):
-        df = pd.read_parquet(path)
-    elif path.lower().endswith(".csv"):
-        df = pd.read_csv(path, low_memory=False)
-    else:
-        raise ValueError("hex_week must be .parquet or .csv")
-
-    lower = {c.lower(): c for c in df.columns}
-    c_h3 = lower.get("h3")
-    c_week = lower.get("week_start")
-    c_count = lower.get("count")
-    if not (c_h3 and c_week and c_count):
-        raise ValueError(f"Expected columns h3, week_start, count. Saw: {list(df.columns)}")
-
-    wk = pd.to_datetime(df[c_week], errors="coerce", utc=True)
-    try:
-        wk = wk.dt.tz_convert("America/Toronto")
-    except Exception:
-        wk = wk.dt.tz_localize("America/Toronto")
-    df = df.rename(columns={c_h3: "h3", c_count: "count"}).assign(week_start=wk)
-    return df[["h3", "week_start", "count"]].dropna()
+
+from h3_cells import PARALLEL_MIN_CELLS, h3_polygons, read_hex_week, write_cells
 
 def main(hex_week_path: str, out_geojson: str,
          baseline_weeks: int = 12, recent_weeks: int = 4,
          z_thresh: float = 1.0, new_min_recent: int = 2,
-         include_unlabeled: int = 0):
+         include_unlabeled: int = 0,
+         boundary_cache: str = "data/processed/h3_boundary_cache.parquet",
+         out_format: str = "geojson", workers: int = None):
 
-    df = read_hex_week(hex_week_path)
-    if df.empty:
+    lf = read_hex_week(hex_week_path, int_ids=True)
+    anchor = lf.select(pl.col("week_start").max()).collect().item()
+    if anchor is None:
         raise SystemExit("hex_week is empty")
-
-    anchor = df["week_start"].max()
+    anchor = pd.Timestamp(anchor)
 
     # Time windows (aligned to weeks; inclusive bounds)
     recent_lo = anchor - pd.Timedelta(days=7 * recent_weeks) + pd.Timedelta(seconds=1)
     base_lo   = anchor - pd.Timedelta(days=7 * (recent_weeks + baseline_weeks)) + pd.Timedelta(seconds=1)
     base_hi   = anchor - pd.Timedelta(days=7 * recent_weeks)
 
-    # Slice windows
-    recent = df[(df["week_start"] > recent_lo) & (df["week_start"] <= anchor)].copy()
-    base   = df[(df["week_start"] > base_lo)   & (df["week_start"] <= base_hi)].copy()
-
-    if recent.empty or base.empty:
-        raise SystemExit(
-            f"Window is empty. recent_weeks={recent_weeks}, baseline_weeks={baseline_weeks}, anchor={anchor.date()}"
-        )
-
-    # --- Baseline metrics per h3 (missing weeks treated as 0) ---
-    # Sum/mean/variance over the baseline period. Start with per-week sums:
-    base_grp = base.groupby(["h3", "week_start"], as_index=False)["count"].sum()
-
-    # Sum & sum of squares over *present* weeks
-    g_sum = base_grp.groupby("h3")["count"].sum().rename("base_sum")
-    g_sumsq = base_grp.groupby("h3")["count"].apply(lambda s: (s ** 2).sum()).rename("base_sumsq")
-    g_weeks_present = base_grp.groupby("h3")["week_start"].nunique().rename("base_weeks_present")
+    wk = pl.col("week_start")
+    in_recent = (wk > recent_lo.to_pydatetime()) & (wk <= anchor.to_pydatetime())
+    in_base   = (wk > base_lo.to_pydatetime())   & (wk <= base_hi.to_pydatetime())
+
+    # Only rows newer than base_lo are read from disk.
+    windowed = read_hex_week(hex_week_path, since=base_lo, inclusive=False, int_ids=True).collect()
+    # hex_week is normally one row per (h3, week_start); only pre-sum per week when it is not
+    if windowed.select(pl.struct("h3", "week_start").is_duplicated().any()).item():
+        windowed = windowed.group_by(["h3", "week_start"]).agg(pl.col("count").sum())
+    weekly = windowed.lazy().with_columns(c2=pl.col("count").cast(pl.Float64) ** 2)
+
+    # Baseline & recent metrics per h3 in a single group-by (missing weeks treated as 0).
+    # Baseline: sum & sum of squares over *present* weeks
+    cnt = pl.col("count")
+    metrics = weekly.group_by("h3").agg(
+        cnt.filter(in_base).sum().alias("base_sum"),
+        pl.col("c2").filter(in_base).sum().alias("base_sumsq"),
+        wk.filter(in_base).n_unique().alias("base_weeks_present"),
+        cnt.filter(in_recent).sum().alias("recent_sum"),
+        wk.filter(in_recent).n_unique().alias("recent_weeks_present"),
+    )
 
-    base_weeks_total = baseline_weeks
-    base_df = pd.concat([g_sum, g_sumsq, g_weeks_present], axis=1).fillna(0)
-    base_df["base_weeks_total"] = base_weeks_total
-    base_df["base_mean"] = base_df["base_sum"] / base_weeks_total
+    # Align on the union of all H3 cells
+    out = (
+        lf.select(pl.col("h3").unique())
+        .join(metrics, on="h3", how="left")
+        .fill_null(0)
+        .sort("h3")
+        .collect()
+        .to_pandas()
+        .set_index("h3")
+    )
 
+    # Derive the scores in float64 with NumPy: polars divides by a scalar via its
+    # reciprocal, which is 1 ulp off and flips ties such as recent_mean == 0.9 * base_mean
+    eps = 1e-6
+    out["base_mean"] = out["base_sum"] / baseline_weeks
     # Population variance proxy including zeros:
     # E[X^2] over all weeks ≈ (sum of squares + zeros) / W = base_sumsq / W
-    base_df["ex2_all"] = base_df["base_sumsq"] / base_weeks_total
-    base_df["base_std"] = np.sqrt(np.maximum(base_df["ex2_all"] - base_df["base_mean"] ** 2, 0.0))
-
-    # --- Recent metrics per h3 (missing weeks treated as 0) ---
-    recent_grp = recent.groupby(["h3", "week_start"], as_index=False)["count"].sum()
-    r_sum = recent_grp.groupby("h3")["count"].sum().rename("recent_sum")
-    r_weeks_present = recent_grp.groupby("h3")["week_start"].nunique().rename("recent_weeks_present")
-
-    recent_df = pd.concat([r_sum, r_weeks_present], axis=1).fillna(0)
-    recent_df["recent_weeks_total"] = recent_weeks
-    recent_df["recent_mean"] = recent_df["recent_sum"] / recent_weeks
-
-    # Join baseline & recent on the union of all H3 cells
-    idx = pd.Index(sorted(set(df["h3"])))
-    out = pd.DataFrame(index=idx).join([base_df, recent_df]).fillna(0)
-
-    # z-like score
-    eps = 1e-6
+    out["base_std"] = np.sqrt(np.maximum(out["base_sumsq"] / baseline_weeks - out["base_mean"] ** 2, 0.0))
+    out["recent_mean"] = out["recent_sum"] / recent_weeks
     out["delta"] = out["recent_mean"] - out["base_mean"]
+    # z-like score
     out["z"] = out["delta"] / (out["base_std"] + eps)
 
+    if not (out["recent_weeks_present"] > 0).any() or not (out["base_weeks_present"] > 0).any():
+        raise SystemExit(
+            f"Window is empty. recent_weeks={recent_weeks}, baseline_weeks={baseline_weeks}, anchor={anchor.date()}"
+        )
+
     # Citywide high-baseline threshold (Q75 of base_mean)
     city_q75 = float(np.quantile(out["base_mean"].to_numpy(), 0.75)) if len(out) else 0.0
 
-    # Labeling rules
-    def label_row(r):
-        # New: baseline ~ 0 and recent has at least `new_min_recent`
-        if (r["base_sum"] <= 0.5) and (r["recent_sum"] >= new_min_recent):
-            return "New"
-        # Intensifying: recent significantly above baseline
-        if (r["recent_sum"] >= new_min_recent) and (r["z"] >= z_thresh):
-            return "Intensifying"
-        # Persistent: baseline high (≥ Q75) and recent also high
-        if (r["base_mean"] >= city_q75) and (r["recent_mean"] >= max(city_q75, r["base_mean"] * 0.9)):
-            return "Persistent"
-        return "None"
-
-    out["label"] = out.apply(label_row, axis=1)
+    # Labeling rules (first match wins, evaluated column-wise)
+    base_sum = out["base_sum"].to_numpy()
+    recent_sum = out["recent_sum"].to_numpy()
+    base_mean = out["base_mean"].to_numpy()
+    recent_mean = out["recent_mean"].to_numpy()
+    # New: baseline ~ 0 and recent has at least `new_min_recent`
+    is_new = (base_sum <= 0.5) & (recent_sum >= new_min_recent)
+    # Intensifying: recent significantly above baseline
+    is_intens = (recent_sum >= new_min_recent) & (out["z"].to_numpy() >= z_thresh)
+    # Persistent: baseline high (≥ Q75) and recent also high
+    is_pers = (base_mean >= city_q75) & (recent_mean >= np.maximum(city_q75, base_mean * 0.9))
+
+    out["label"] = np.select([is_new, is_intens, is_pers],
+                             ["New", "Intensifying", "Persistent"], default="None")
 
     # Keep labeled only unless include_unlabeled=1
     if not include_unlabeled:
         out = out[out["label"] != "None"].copy()
 
+    # Back to canonical H3 strings (lowercase hex) for polygons & GeoJSON
+    out.index = pd.Index([format(int(h), "x") for h in out.index], name="h3")
+
     if out.empty:
         print("[WARN] No cells met labeling rules. Try lowering thresholds (e.g., --z_thresh 0.5, --new_min_recent 1).")
 
     # Build polygons
-    rows, polys = [], []
-    for h, r in out.iterrows():
-        try:
-            poly = Polygon(h3_boundary_lonlat(h))
-            polys.append(poly)
-            rows.append({
-                "h3": h,
-                "label": r["label"],
-                "baseline_mean": round(float(r["base_mean"]), 4),
-                "recent_mean":   round(float(r["recent_mean"]), 4),
-                "delta":         round(float(r["delta"]), 4),
-                "z":             round(float(r["z"]), 3),
-                "baseline_std":  round(float(r["base_std"]), 4),
-                "baseline_sum":  int(r["base_sum"]),
-                "recent_sum":    int(r["recent_sum"]),
-                "baseline_weeks": int(baseline_weeks),
-                "recent_weeks":   int(recent_weeks),
-                "anchor_date":    str(anchor.date())
-            })
-        except Exception:
-            continue
+    polys = h3_polygons(out.index, cache_path=boundary_cache, workers=workers)
+    valid = shapely.is_valid(polys)
+    if not valid.all():
+        print(f"[WARN] skipping {int((~valid).sum())} invalid cell polygons:",
+              shapely.is_valid_reason(polys[~valid][0]))
+        out, polys = out[valid], polys[valid]
+
+    # Pull columns out once; iterrows() would box every row into a Series
+    h_arr = out.index.to_numpy()
+    lbl = out["label"].to_numpy()
+    bm, rm = out["base_mean"].to_numpy(), out["recent_mean"].to_numpy()
+    dl, zz = out["delta"].to_numpy(), out["z"].to_numpy()
+    bsd = out["base_std"].to_numpy()
+    bs, rs = out["base_sum"].to_numpy(), out["recent_sum"].to_numpy()
+    anchor_date = str(anchor.date())
+
+    rows = []
+    for i, h in enumerate(h_arr):
+        rows.append({
+            "h3": h,
+            "label": lbl[i],
+            "baseline_mean": round(float(bm[i]), 4),
+            "recent_mean":   round(float(rm[i]), 4),
+            "delta":         round(float(dl[i]), 4),
+            "z":             round(float(zz[i]), 3),
+            "baseline_std":  round(float(bsd[i]), 4),
+            "baseline_sum":  int(bs[i]),
+            "recent_sum":    int(rs[i]),
+            "baseline_weeks": int(baseline_weeks),
+            "recent_weeks":   int(recent_weeks),
+            "anchor_date":    anchor_date
+        })
 
     gdf = gpd.GeoDataFrame(rows, geometry=polys, crs="EPSG:4326")
-    Path(out_geojson).parent.mkdir(parents=True, exist_ok=True)
-    gdf.to_file(out_geojson, driver="GeoJSON")
-    print(f"[OK] wrote {out_geojson} — cells: {len(gdf):,}")
+    out_path = write_cells(gdf, out_geojson, fmt=out_format)
+    print(f"[OK] wrote {out_path} — cells: {len(gdf):,}")
     print(f"anchor={anchor.date()} | baseline_weeks={baseline_weeks} | recent_weeks={recent_weeks}")
     print("labels:", dict(zip(*np.unique(gdf['label'], return_counts=True))))
 
-if __name__ == "__main__":
+def cli(argv=None):
+    """Run from command-line style arguments (defaults to sys.argv) in the current process."""
     ap = argparse.ArgumentParser()
     ap.add_argument("--hex_week", required=True)
     ap.add_argument("--out", default="geojson/emerging.geojson")
@@ -195,7 +192,13 @@ if __name__ == "__main__":
     ap.add_argument("--z_thresh", type=float, default=1.0)
     ap.add_argument("--new_min_recent", type=int, default=2)
     ap.add_argument("--include_unlabeled", type=int, default=0)
-    args = ap.parse_args()
+    ap.add_argument("--boundary_cache", default="data/processed/h3_boundary_cache.parquet",
+                    help="parquet cache of H3 cell polygons (h3, wkb); empty string disables")
+    ap.add_argument("--format", default="geojson", choices=["geojson", "fgb", "parquet"],
+                    help="output format; fgb/parquet replace the --out suffix")
+    ap.add_argument("--workers", type=int, default=None,
+                    help=f"processes for polygon building (default: all cores; used from {PARALLEL_MIN_CELLS:,} new cells)")
+    args = ap.parse_args(argv)
 
     # Explicitly map CLI args to main() keyword parameters
     main(
@@ -206,4 +209,10 @@ if __name__ == "__main__":
         z_thresh=args.z_thresh,
         new_min_recent=args.new_min_recent,
         include_unlabeled=args.include_unlabeled,
+        boundary_cache=args.boundary_cache,
+        out_format=args.format,
+        workers=args.workers,
     )
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Shared H3 cell-layer helpers for the exporters in src/:
+  - h3_polygons   : cell polygons in bulk (parquet WKB cache, process pool for big batches)
+  - write_cells   : GeoJSON / FlatGeobuf / GeoParquet writer
+  - read_hex_week : lazy polars scan of hex_week.{parquet|csv}
+
+Scripts run as `python src/<script>.py` import it as a sibling module:
+    from h3_cells import h3_polygons, write_cells
+"""
+
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+__all__ = ["PARALLEL_MIN_CELLS", "h3_boundary_lonlat", "h3_polygons", "write_cells", "read_hex_week"]
+
+try:
+    import shapely
+except ImportError:
+    raise SystemExit("shapely required. Install via conda-forge.")
+try:
+    import pyogrio  # bulk GeoJSON writer; falls back to GeoDataFrame.to_file
+except ImportError:
+    pyogrio = None
+try:
+    import polars as pl  # only read_hex_week needs it
+except ImportError:
+    pl = None
+try:
+    import h3
+except ImportError:
+    raise SystemExit("h3-py (v3 or v4) required.")
+
+# Polygon building fans out to worker processes only for at least this many new cells;
+# below it process start-up costs more than it saves
+PARALLEL_MIN_CELLS = 50_000
+
+# --- H3 v3/v4 boundary helper (returns list of (lon, lat)) ---
+@lru_cache(maxsize=None)
+def h3_boundary_lonlat(h):
+    if hasattr(h3, "h3_to_geo_boundary"):  # v3
+        return h3.h3_to_geo_boundary(h, geo_json=True)
+    pts = h3.cell_to_boundary(h)          # v4: (lat, lon)
+    return [(lon, lat) for (lat, lon) in pts]
+
+def _build_polygons(cells):
+    """Polygons for `cells` from a preallocated (N, 7, 2) lon/lat buffer and one shapely.polygons call."""
+    polys = np.empty(len(cells), dtype=object)
+    coords = np.empty((len(cells), 7, 2), dtype=np.float64)
+    batch = []
+    for i, h in enumerate(cells):
+        b = h3_boundary_lonlat(h)
+        if len(b) <= 7:
+            coords[len(batch), :len(b)] = b
+            coords[len(batch), len(b):] = b[0]  # close the ring (pads pentagons)
+            batch.append(i)
+        else:  # distortion vertices near icosahedron edges: up to 10 points
+            polys[i] = shapely.polygons(np.asarray(b, dtype=np.float64))
+    polys[batch] = shapely.polygons(coords[:len(batch)])
+    return polys
+
+def _build_polygons_wkb(cells):
+    # process-pool worker: WKB pickles far cheaper than geometry objects
+    return shapely.to_wkb(_build_polygons(cells))
+
+def h3_polygons(cells, cache_path=None, workers=None):
+    """
+    Polygons for many cells in one shapely call; rings padded to 7 points (closes hexagons & pentagons).
+    With `cache_path`, polygons are reused from / appended to a parquet (h3, wkb) cache.
+    Large batches of new cells are split across `workers` processes (default: all cores).
+    """
+    cells = np.asarray(cells, dtype=object)
+    polys = np.empty(len(cells), dtype=object)
+    todo = np.ones(len(cells), dtype=bool)
+    cache = None
+    if cache_path and Path(cache_path).exists():
+        try:
+            cache = pd.read_parquet(cache_path, columns=["h3", "wkb"])
+            pos = pd.Index(cache["h3"]).get_indexer(cells)
+            todo = pos < 0
+            polys[~todo] = shapely.from_wkb(cache["wkb"].to_numpy()[pos[~todo]])
+        except Exception as e:
+            print(f"[WARN] ignoring unreadable polygon cache {cache_path} ({e}); rebuilding it")
+            cache = None
+            todo = np.ones(len(cells), dtype=bool)
+    if todo.any():
+        new_cells = cells[todo]
+        workers = workers or os.cpu_count() or 1
+        if workers > 1 and len(new_cells) >= PARALLEL_MIN_CELLS:
+            # never fork: callers have already run polars queries, and forking after its
+            # thread pool has started can deadlock the child
+            ctx = mp.get_context("forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn")
+            with ProcessPoolExecutor(workers, mp_context=ctx) as ex:
+                wkb = list(ex.map(_build_polygons_wkb, np.array_split(new_cells, workers)))
+            polys[todo] = shapely.from_wkb(np.concatenate(wkb))
+        else:
+            polys[todo] = _build_polygons(new_cells)
+        if cache_path:
+            new = pd.DataFrame({"h3": cells[todo], "wkb": shapely.to_wkb(polys[todo])})
+            cache = new if cache is None else pd.concat([cache, new], ignore_index=True)
+            Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+            # write beside the cache and swap it in, so an interrupted run (or a
+            # concurrent reader) never sees a half-written parquet
+            tmp = Path(cache_path).with_name(f"{Path(cache_path).name}.{os.getpid()}.tmp")
+            try:
+                cache.to_parquet(tmp, index=False)
+                os.replace(tmp, cache_path)
+            finally:
+                tmp.unlink(missing_ok=True)
+    return polys
+
+def write_cells(gdf, out_path, fmt="geojson"):
+    """
+    Write the cell layer and return the path written.
+    geojson: text, read by the web map; fgb: FlatGeobuf (binary, streamable);
+    parquet: GeoParquet with GeoArrow geometry encoding.
+    Non-GeoJSON formats swap the file suffix of `out_path`.
+    """
+    out_path = Path(out_path)
+    if fmt != "geojson":
+        out_path = out_path.with_suffix("." + fmt)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    if fmt == "parquet":
+        gdf.to_parquet(out_path, index=False, geometry_encoding="geoarrow")
+        return out_path
+    driver = {"geojson": "GeoJSON", "fgb": "FlatGeobuf"}[fmt]
+    if pyogrio is not None:
+        pyogrio.write_dataframe(gdf, out_path, driver=driver)
+    else:
+        gdf.to_file(out_path, driver=driver)
+    return out_path
+
+def read_hex_week(path: str, since=None, inclusive=True, int_ids=False) -> "pl.LazyFrame":
+    """
+    Scan parquet/csv lazily; returns columns h3, week_start (Toronto tz), count.
+    `since` keeps only week_start >= since (> since with inclusive=False); it is applied
+    to the raw parquet column so row groups outside the window are skipped via their
+    min/max statistics.
+    int_ids=True returns h3 as uint64 instead of the hex string, so downstream
+    group-bys/joins hash a plain integer (convert back with format(h, "x")).
+    """
+    if pl is None:
+        raise SystemExit("polars required. Install via conda-forge.")
+    path = str(path)
+    if path.lower().endswith(".parquet"):
+        lf = pl.scan_parquet(path)
+    elif path.lower().endswith(".csv"):
+        lf = pl.scan_csv(path)
+    else:
+        raise ValueError("hex_week must be .parquet or .csv")
+
+    schema = lf.collect_schema()
+    lower = {c.lower(): c for c in schema.names()}
+    c_h3 = lower.get("h3")
+    c_week = lower.get("week_start")
+    c_count = lower.get("count")
+    if not (c_h3 and c_week and c_count):
+        raise ValueError(f"Expected columns h3, week_start, count. Saw: {schema.names()}")
+
+    # Same semantics as pd.to_datetime(..., utc=True): naive values are read as UTC
+    wk = pl.col(c_week)
+    tz = getattr(schema[c_week], "time_zone", None)
+    if schema[c_week] == pl.String:
+        wk = wk.str.to_datetime(time_zone="UTC", strict=False)
+    elif tz is None:
+        wk = wk.cast(pl.Datetime("us")).dt.replace_time_zone("UTC")
+    wk = wk.dt.convert_time_zone("America/Toronto")
+
+    def after(col, ts):
+        return col >= ts if inclusive else col > ts
+
+    if since is not None and schema[c_week] != pl.String:
+        since = pd.Timestamp(since).tz_convert(tz or "UTC")
+        lf = lf.filter(after(pl.col(c_week), (since if tz else since.tz_localize(None)).to_pydatetime()))
+    h3_col = pl.col(c_h3)
+    if not int_ids:
+        h3_col = h3_col.cast(pl.String)
+    elif not schema[c_h3].is_integer():
+        h3_col = h3_col.cast(pl.String).str.to_integer(base=16, strict=False).cast(pl.UInt64)
+    else:
+        h3_col = h3_col.cast(pl.UInt64)
+    out = lf.select(
+        h3_col.alias("h3"),
+        wk.alias("week_start"),
+        pl.col(c_count).cast(pl.Int32).alias("count"),
+    ).drop_nulls()
+    if since is not None and schema[c_week] == pl.String:
+        out = out.filter(after(pl.col("week_start"), pd.Timestamp(since).to_pydatetime()))
+    return out
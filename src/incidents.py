@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Shared helpers for the incident-level scripts in src/ (preprocess_h3_week, near_repeat_knox):
+  - h3_index_array       : H3 cells (str) for whole lat/lon arrays
+  - read_csv_columns     : read only the needed CSV columns (pyarrow's threaded reader if present)
+  - parse_date_plus_time : naive timestamps from an ISO date + "HH:MM:SS" time column
+  - filter_offence       : keep rows whose offence label matches a regex (case-insensitive)
+
+Scripts run as `python src/<script>.py` import it as a sibling module:
+    from incidents import filter_offence, h3_index_array, parse_date_plus_time, read_csv_columns
+"""
+
+import numpy as np
+import pandas as pd
+
+__all__ = ["h3_index", "h3_index_array", "read_csv_columns", "parse_date_plus_time",
+           "filter_offence"]
+
+try:
+    import h3  # conda install -c conda-forge h3-py
+except ImportError:
+    raise SystemExit("Missing h3-py. Install with: conda install -c conda-forge h3-py")
+
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pacsv  # optional: multi-threaded CSV reader
+except ImportError:
+    pa = pacsv = None
+
+# --- H3 v3/v4 compatibility ---
+def h3_index(lat, lon, res):
+    # v3: geo_to_h3; v4: latlng_to_cell
+    if hasattr(h3, "geo_to_h3"):
+        return h3.geo_to_h3(lat, lon, res)
+    return h3.latlng_to_cell(lat, lon, res)
+
+def h3_index_array(lat, lon, res):
+    """
+    H3 cells (str) for whole lat/lon arrays.
+    h3-py v3 ships a numpy-vectorized geo_to_h3 (h3.unstable.vect); v4 has no
+    batch call, so each *distinct* (lat, lon) is indexed once and broadcast
+    back (TPS snaps incidents to intersections, so coordinates repeat a lot).
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    vect = getattr(getattr(h3, "unstable", None), "vect", None)
+    if vect is not None and hasattr(vect, "geo_to_h3"):
+        # stringify each distinct uint64 id once, then broadcast back
+        ids, inv = np.unique(vect.geo_to_h3(lat, lon, res), return_inverse=True)
+        cells = np.array([h3.h3_to_string(int(x)) for x in ids], dtype=object)
+        return cells[inv.ravel()]
+    uniq, inv = np.unique(np.c_[lat, lon], axis=0, return_inverse=True)
+    cells = np.fromiter((h3_index(a, b, res) for a, b in uniq.tolist()), dtype=object, count=len(uniq))
+    return cells[inv.ravel()]
+
+def read_csv_columns(path, columns, str_columns=()):
+    """
+    Read only `columns` from the CSV: pyarrow's multi-threaded reader if available,
+    pandas otherwise. `str_columns` stay raw strings (no date/time type inference).
+    """
+    columns = list(dict.fromkeys(columns))
+    if pacsv is None:
+        return pd.read_csv(path, usecols=columns, low_memory=False)
+    tbl = pacsv.read_csv(
+        path,
+        read_options=pacsv.ReadOptions(use_threads=True),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=columns,
+            column_types={c: pa.string() for c in str_columns},
+        ),
+    )
+    return tbl.to_pandas(split_blocks=True, self_destruct=True)
+
+def parse_date_plus_time(date, time):
+    """
+    Naive timestamps from an ISO date column + "HH:MM:SS" time column, each parsed
+    on its own (no joined string column). Rows in any other layout go through the
+    generic parser on "date time".
+    """
+    # only real HH:MM:SS strings go to to_timedelta, which would read a bare "13" as 13 ns
+    time_str = time.astype(str)
+    hms = time_str.str.fullmatch(r"([01]?\d|2[0-3]):[0-5]\d:[0-5]\d")
+    dt = pd.to_datetime(date, errors="coerce", format="%Y-%m-%d") + \
+         pd.to_timedelta(time_str.where(hms), errors="coerce")
+    bad = dt.isna() & date.notna() & time.notna()
+    if bad.any():
+        dt[bad] = pd.to_datetime(date[bad].astype(str) + " " + time[bad].astype(str), errors="coerce")
+    return dt
+
+def filter_offence(df, col, pattern):
+    """
+    Rows of `df` whose `col` label contains the regex `pattern` (case-insensitive).
+    The regex runs once per distinct label; rows are then selected by category code.
+    """
+    off = df[col].astype("category").cat
+    hit = off.categories.astype(str).str.contains(pattern, case=False, na=False)
+    return df[np.isin(off.codes.to_numpy(), np.flatnonzero(hit))]
@@ -18,7 +18,6 @@ python src/near_repeat_knox.py \
 """
 
 import argparse
-from pathlib import Path
 import numpy as np
 import pandas as pd
 
@@ -28,34 +27,33 @@ try:
 except ImportError:
     raise SystemExit("Need h3. Try: conda install -c conda-forge h3-py")
 try:
-    from sklearn.neighbors import BallTree
+    from scipy.spatial import cKDTree
 except Exception:
-    raise SystemExit("Need scikit-learn. Try: conda install -c conda-forge scikit-learn")
+    raise SystemExit("Need scipy. Try: conda install -c conda-forge scipy")
+try:
+    from joblib import Parallel, delayed, effective_n_jobs  # optional: permutation blocks across cores
+except ImportError:
+    Parallel = delayed = effective_n_jobs = None
+try:
+    from numba import njit, prange  # optional: fused Knox compare kernel
+except ImportError:
+    njit = None
 try:
     import geopandas as gpd
-    from shapely.geometry import Polygon
 except Exception:
     raise SystemExit("Need geopandas+shapely. Try: conda install -c conda-forge geopandas shapely")
 
+from h3_cells import h3_polygons, write_cells
+from incidents import filter_offence, h3_index_array, parse_date_plus_time, read_csv_columns
+
 EARTH_RADIUS_M = 6_371_000.0
 
 # ---------- H3 v3/v4 compat ----------
-def h3_cell(lat, lon, res):
-    if hasattr(h3, "geo_to_h3"):                    # v3
-        return h3.geo_to_h3(lat, lon, res)
-    return h3. latlng_to_cell(lat, lon, res)        # v4
-
 def h3_k_ring(h, k):
     if hasattr(h3, "k_ring"):                       # v3
         return set(h3.k_ring(h, k))
     return set(h3.grid_disk(h, k))                  # v4
 
-def h3_boundary_lonlat(h):
-    if hasattr(h3, "h3_to_geo_boundary"):            # v3
-        return h3.h3_to_geo_boundary(h, geo_json=True)
-    pts = h3.cell_to_boundary(h)                     # v4 -> (lat,lon)
-    return [(lon, lat) for (lat, lon) in pts]
-
 # ---------- column guessing ----------
 CANDS = {
     "lat": ["lat_wgs84","latitude","lat","y"],
@@ -70,21 +68,26 @@ def pick(colnames, pool):
         if k in low: return low[k]
     return None
 
+def localize_toronto(naive):
+    # tz_localize only the distinct wall-clock values (dates/hours repeat heavily),
+    # then scatter back: N per-element DST lookups become U, the rest is an int64 take
+    codes, vals = pd.factorize(naive, use_na_sentinel=False)
+    loc = pd.DatetimeIndex(vals).tz_localize("America/Toronto", nonexistent="shift_forward", ambiguous="NaT")
+    return pd.Series(loc.take(codes), index=naive.index)
+
 def to_toronto_dt(df, c_date, c_time):
     # combine date/time to tz-aware Toronto timestamp
     if c_time is None:
-        dt = pd.to_datetime(df[c_date], errors="coerce", utc=False)
-        dt = dt.dt.tz_localize("America/Toronto", nonexistent="shift_forward", ambiguous="NaT")
+        dt = localize_toronto(pd.to_datetime(df[c_date], errors="coerce", utc=False))
         return dt.dt.floor("T")
     if pd.api.types.is_numeric_dtype(df[c_time]):
-        base = pd.to_datetime(df[c_date], errors="coerce", utc=False).dt.floor("D")
-        base = base.dt.tz_localize("America/Toronto", nonexistent="shift_forward", ambiguous="NaT")
+        base = localize_toronto(pd.to_datetime(df[c_date], errors="coerce", utc=False).dt.floor("D"))
         hour = pd.to_numeric(df[c_time], errors="coerce").fillna(0).clip(0,23).astype(int)
         return base + pd.to_timedelta(hour, unit="h")
-    comb = df[c_date].astype(str) + " " + df[c_time].astype(str)
-    dt = pd.to_datetime(comb, errors="coerce", utc=False)
+    # ISO date + "HH:MM:SS" parsed separately and summed; other layouts via "date time"
+    dt = parse_date_plus_time(df[c_date], df[c_time])
     if getattr(dt.dtype, "tz", None) is None:
-        dt = dt.dt.tz_localize("America/Toronto", nonexistent="shift_forward", ambiguous="NaT")
+        dt = localize_toronto(dt)
     else:
         dt = dt.dt.tz_convert("America/Toronto")
     return dt
@@ -93,57 +96,136 @@ def to_toronto_dt(df, c_date, c_time):
 def knox_observed_pairs(lat_rad, lon_rad, ts_ns, d_m, t_days):
     """
     Count pairs with distance <= d_m and |delta_t| <= t_days.
-    Use BallTree(haversine) to precompute spatial neighbors, then filter by time.
-    Returns: observed_count, pair_index ndarray shape (P,2) with i<j
+    Project to a local equirectangular frame (meters; <<1 m error at city scale),
+    let cKDTree.query_pairs return the i<j spatial pairs, then filter by time.
+    The tree is built on incidents sorted by time, so for a pair i<j the time
+    test is an index compare, j < right[i], with right from one searchsorted.
+    Returns: observed_count, (indptr, indices) — the kept pairs as CSR rows:
+    neighbours j > i of incident i are indices[indptr[i]:indptr[i+1]] (int32)
     """
-    coords = np.c_[lat_rad, lon_rad]
-    tree = BallTree(coords, metric="haversine")
-    r = d_m / EARTH_RADIUS_M  # meters -> radians
-    # neighbors for each point, includes self
-    inds = tree.query_radius(coords, r=r, return_distance=False)
-
-    pairs = []
-    n = len(coords)
-    for i in range(n):
-        neigh = inds[i]
-        if len(neigh) == 0: continue
-        # keep j>i to avoid double count
-        js = neigh[neigh > i]
-        if js.size:
-            pairs.extend([(i, int(j)) for j in js])
-    if not pairs:
-        return 0, np.empty((0,2), dtype=int)
-
-    pairs = np.asarray(pairs, dtype=int)
-    # time filter
-    tdiff = np.abs(ts_ns[pairs[:,0]] - ts_ns[pairs[:,1]])
-    within = tdiff <= (t_days * 24 * 3600 * 1e9)  # days -> ns
-    obs = int(np.sum(within))
-    return obs, pairs[within]
-
-def knox_permute_counts(ts_ns, pairs, t_days, R=500, seed=42):
+    lat0, lon0 = lat_rad.mean(), lon_rad.mean()
+    xy = np.c_[EARTH_RADIUS_M * np.cos(lat0) * (lon_rad - lon0),
+               EARTH_RADIUS_M * (lat_rad - lat0)]
+    order = np.argsort(ts_ns, kind="stable")
+    tree = cKDTree(xy[order], leafsize=32)
+    pairs = tree.query_pairs(r=d_m, output_type="ndarray")
+    if len(pairs) == 0:
+        return 0, (np.zeros(len(ts_ns) + 1, dtype=np.int64), np.empty(0, dtype=np.int32))
+
+    # time filter: in time order, the j within t_days after i are exactly i < j < right[i]
+    ts_sorted = ts_ns[order]
+    right = np.searchsorted(ts_sorted, ts_sorted + int(t_days * 24 * 3600 * 10**9), side="right")
+    pairs = pairs[pairs[:,1] < right[pairs[:,0]]]
+    obs = len(pairs)
+    # back to input positions (i < j) for the permutation step
+    return obs, pairs_to_csr(np.sort(order[pairs], axis=1), len(ts_ns))
+
+def pairs_to_csr(pairs, n):
+    # (P, 2) i<j pairs -> CSR by i; a P-long int32 column instead of a (P, 2) int64 array
+    order = np.argsort(pairs[:,0], kind="stable")
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pairs[:,0], minlength=n), out=indptr[1:])
+    return indptr, pairs[order, 1].astype(np.int32)
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _knox_block_counts(tperm, indptr, indices, thresh):
+        # walk the CSR rows: t_i loaded once per incident, then a contiguous run of j's;
+        # load/subtract/abs/compare/accumulate in one pass, no (b, P) temporaries
+        B, n = tperm.shape
+        out = np.zeros(B, np.int64)
+        for r in prange(B):
+            c = 0
+            for i in range(n):
+                ti = tperm[r, i]
+                for k in range(indptr[i], indptr[i + 1]):
+                    d = ti - tperm[r, indices[k]]
+                    if d < 0:
+                        d = -d
+                    if d <= thresh:
+                        c += 1
+            out[r] = c
+        return out
+
+def _permute_block(seed, b, ts_ns, indptr, indices, thresh, p0=None):
     """
-    Fix spatial pairs; permute timestamps R times; count time-within pairs.
-    Returns: np.array shape (R,)
+    One block of b permutations: (b, n) row-wise shuffled timestamps, one broadcasted compare.
+    p0 is the CSR row of each pair (needed without numba; expanded once by the caller).
     """
     rng = np.random.default_rng(seed)
-    n = len(ts_ns)
-    counts = np.empty(R, dtype=int)
-    thresh = (t_days * 24 * 3600 * 1e9)
-    for r in range(R):
-        perm = rng.permutation(n)
-        tperm = ts_ns[perm]
-        td = np.abs(tperm[pairs[:,0]] - tperm[pairs[:,1]])
-        counts[r] = int(np.sum(td <= thresh))
-    return counts
+    tperm = rng.permuted(np.tile(ts_ns, (b, 1)), axis=1)   # (b, n), row-wise Fisher–Yates
+    if njit is not None:
+        return _knox_block_counts(tperm, indptr, indices, np.int64(thresh))
+    td = np.abs(tperm[:, p0] - tperm[:, indices])          # (b, P)
+    return (td <= thresh).sum(axis=1, dtype=np.int64)
+
+def wilson_upper(x, n, z=1.96):
+    """Upper bound of the Wilson score interval for a proportion x/n."""
+    p = x / n
+    centre = p + z * z / (2 * n)
+    half = z * np.sqrt(p * (1 - p) / n + z * z / (4 * n * n))
+    return (centre + half) / (1 + z * z / n)
+
+def knox_permute_counts(ts_ns, csr, t_days, R=500, seed=42, block=64, n_jobs=-1,
+                        obs=None, alpha=None, min_perm=128):
+    """
+    Fix spatial pairs (CSR from knox_observed_pairs); permute timestamps R times;
+    count time-within pairs.
+    Permutations run in blocks of B (capped so the (B, P) temporaries stay
+    around 8M elements). Each block draws from its own child of
+    SeedSequence(seed), so blocks can run on n_jobs processes (joblib) and
+    the result does not depend on how many cores were used. With numba the
+    compare runs in a prange kernel that already uses every core, so blocks
+    then stay in-process.
+    Sequential stopping: with obs and alpha set, blocks run in waves of at
+    least min_perm permutations (and at least one block per joblib worker),
+    and after each wave the run stops once the Wilson upper bound on
+    P(sim >= obs) is below alpha. The p-value is then decided; the remaining
+    permutations would not change the decision. The counts are always a
+    prefix of the full-R sequence; with joblib, R_used rounds up to whole
+    waves and so can grow with the worker count.
+    Returns: np.array shape (R_used,), R_used <= R
+    """
+    # Only |t_i - t_j| <= thresh matters, so permute int32 seconds since the first
+    # incident instead of int64 ns: half the bytes in the gather/compare.
+    # Exact for whole-second timestamps; anything else stays in ns.
+    ts = ts_ns - ts_ns.min()
+    if not (ts % 10**9).any() and ts.max() // 10**9 <= np.iinfo(np.int32).max:
+        ts_ns, thresh = (ts // 10**9).astype(np.int32), int(t_days * 24 * 3600)
+    else:
+        thresh = int(t_days * 24 * 3600 * 10**9)
+    indptr, indices = csr
+    block = max(1, min(block, 8_000_000 // max(len(indices), 1)))
+    # NumPy path: the first index of every pair, expanded from the CSR once for all blocks
+    p0 = None if njit is not None else np.repeat(np.arange(len(ts_ns)), np.diff(indptr))
+    sizes = [min(block, R - lo) for lo in range(0, R, block)]
+    jobs = list(zip(np.random.SeedSequence(seed).spawn(len(sizes)), sizes))
+    sequential = bool(alpha) and obs is not None
+    use_pool = Parallel is not None and njit is None and n_jobs != 1
+    wave = max(len(jobs), 1)
+    if sequential:
+        # a wave covers min_perm permutations and, with joblib, at least one block per worker
+        wave = max(-(-min_perm // block), effective_n_jobs(n_jobs) if use_pool else 1)
+    parts = []
+    for lo in range(0, len(jobs), wave):
+        todo = jobs[lo:lo + wave]
+        if use_pool and len(todo) > 1:
+            parts += Parallel(n_jobs=n_jobs)(
+                delayed(_permute_block)(sd, b, ts_ns, indptr, indices, thresh, p0) for sd, b in todo)
+        else:
+            parts += [_permute_block(sd, b, ts_ns, indptr, indices, thresh, p0) for sd, b in todo]
+        if sequential and lo + wave < len(jobs):
+            sim = np.concatenate(parts)
+            if wilson_upper((sim >= obs).sum(), sim.size) < alpha:
+                break
+    return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
 
 # ---------- main pipeline ----------
 def main(csv, out_geojson, h3_res=9, distance_m=250, time_days=14,
-         lookback_days=90, recent_days=14, k=1, permutations=500,
+         lookback_days=90, recent_days=14, k=1, permutations=500, n_jobs=-1, stop_alpha=0.05,
          latcol=None, loncol=None, datecol=None, timecol=None,
          offencecol=None, offence_filter=None):
-    df = pd.read_csv(csv, low_memory=False)
-    cols = list(df.columns)
+    cols = list(pd.read_csv(csv, nrows=0).columns)
 
     c_lat = latcol or pick(cols, CANDS["lat"])
     c_lon = loncol or pick(cols, CANDS["lon"])
@@ -153,13 +235,15 @@ def main(csv, out_geojson, h3_res=9, distance_m=250, time_days=14,
     if any(c is None for c in [c_lat, c_lon, c_date]):
         raise SystemExit(f"Required columns missing. Saw: {cols}\n"
                          "Use --latcol/--loncol/--datecol/--timecol to specify.")
+    df = read_csv_columns(csv, [c for c in [c_lat, c_lon, c_date, c_time, c_off] if c],
+                          str_columns=[c_date])
 
     df["lat"] = pd.to_numeric(df[c_lat], errors="coerce")
     df["lon"] = pd.to_numeric(df[c_lon], errors="coerce")
     df = df.dropna(subset=["lat","lon"])
 
     if offence_filter and c_off:
-        df = df[df[c_off].astype(str).str.contains(offence_filter, case=False, na=False)]
+        df = filter_offence(df, c_off, offence_filter)
 
     # datetime and filters
     df["dt"] = to_toronto_dt(df, c_date, c_time)
@@ -169,8 +253,11 @@ def main(csv, out_geojson, h3_res=9, distance_m=250, time_days=14,
     # now = pd.Timestamp.now(tz="America/Toronto")
     # df = df[df["dt"] >= (now - pd.Timedelta(days=lookback_days))].copy()
     anchor = df["dt"].max()
-    cut_lo = anchor - pd.Timedelta(days=lookback_days)
-    df = df[(df["dt"] >= cut_lo) & (df["dt"] <= anchor)].copy()
+    # window filter on int64 ns since epoch (UTC); the same array feeds the Knox test
+    ts_ns = df["dt"].dt.tz_convert("UTC").dt.as_unit("ns").astype("int64").to_numpy()
+    lo_ns, hi_ns = (anchor - pd.Timedelta(days=lookback_days)).value, anchor.value
+    keep = (ts_ns >= lo_ns) & (ts_ns <= hi_ns)
+    df, ts_ns = df[keep].copy(), ts_ns[keep]
     print("anchor date:", anchor.date())
     if df.empty:
         raise SystemExit("No incidents in lookback window.")
@@ -178,69 +265,64 @@ def main(csv, out_geojson, h3_res=9, distance_m=250, time_days=14,
     # arrays
     lat_rad = np.deg2rad(df["lat"].to_numpy())
     lon_rad = np.deg2rad(df["lon"].to_numpy())
-    # ts_ns   = df["dt"].view("int64").to_numpy()  # ns since epoch (tz-aware ok in pandas)
-    ts_ns = df["dt"].dt.tz_convert("UTC").astype("int64").to_numpy()
 
     # Knox observed + spatial pairs
-    obs, pairs = knox_observed_pairs(lat_rad, lon_rad, ts_ns, distance_m, time_days)
+    obs, csr = knox_observed_pairs(lat_rad, lon_rad, ts_ns, distance_m, time_days)
+    n_pairs = csr[1].size
 
-    if pairs.size == 0:
+    if n_pairs == 0:
         print("[INFO] No space<=d candidates; try larger distance or longer lookback.")
         sim = np.zeros(permutations, dtype=int)
         pval = 1.0
         z = np.nan
     else:
         # Permutation
-        sim = knox_permute_counts(ts_ns, pairs, time_days, R=permutations, seed=42)
-        mu, sd = float(sim.mean()), float(sim.std(ddof=1)) if permutations>1 else (sim.mean(), 0.0)
-        # Monte Carlo p-value (right-tailed)
-        pval = (1 + np.sum(sim >= obs)) / (permutations + 1)
+        sim = knox_permute_counts(ts_ns, csr, time_days, R=permutations, seed=42, n_jobs=n_jobs,
+                                  obs=obs, alpha=stop_alpha)
+        mu = sim.mean()
+        sd = sim.std(ddof=1) if sim.size > 1 else 0.0
+        # Monte Carlo p-value (right-tailed), over the permutations actually run
+        pval = (1 + (sim >= obs).sum()) / (sim.size + 1)
         z = (obs - mu) / sd if sd > 0 else np.inf
 
     print("=== Knox near-repeat ===")
     print(f"n incidents: {len(df):,} (lookback={lookback_days}d, filter={offence_filter or 'None'})")
     print(f"thresholds: distance≤{distance_m} m, time≤{time_days} d")
-    if pairs.size:
+    if n_pairs:
         print(f"observed pairs: {obs:,}")
-        print(f"null mean±sd: {sim.mean():.1f} ± {sim.std(ddof=1):.1f} (R={permutations})")
+        r_note = "" if sim.size == permutations else f" of {permutations}, stopped early"
+        print(f"null mean±sd: {sim.mean():.1f} ± {sim.std(ddof=1):.1f} (R={sim.size}{r_note})")
         print(f"Monte-Carlo p-value: {pval:.5f} | z≈{z:.2f}")
     else:
         print("observed pairs: 0")
 
     # ----- build attention layer (recent incidents -> k-ring coverage) -----
     # recent = df[df["dt"] >= (now - pd.Timedelta(days=recent_days))].copy()
-    recent = df[df["dt"] >= (anchor - pd.Timedelta(days=recent_days))].copy()
+    recent = df[ts_ns >= (anchor - pd.Timedelta(days=recent_days)).value].copy()
     if recent.empty:
         print(f"[WARN] No incidents in recent {recent_days} days; attention layer will be empty.")
-        gpd.GeoDataFrame({"h3":[], "coverage":[]}, geometry=[], crs="EPSG:4326") \
-            .to_file(out_geojson, driver="GeoJSON")
+        write_cells(gpd.GeoDataFrame({"h3":[], "coverage":[]}, geometry=[], crs="EPSG:4326"),
+                    out_geojson)
         return
 
-    # count coverage of k-ring cells
-    cells = {}
-    for lat, lon in zip(recent["lat"].to_numpy(), recent["lon"].to_numpy()):
-        c = h3_cell(lat, lon, h3_res)
-        ring = h3_k_ring(c, k)
-        for h in ring:
-            cells[h] = cells.get(h, 0) + 1
-
-    # polygons
-    rows = []
-    polys = []
-    for h, cov in cells.items():
-        try:
-            poly = Polygon(h3_boundary_lonlat(h))
-            polys.append(poly)
-            rows.append({"h3": h, "coverage": int(cov),
-                         "window_days": int(recent_days),
-                         "k": int(k),
-                         "p_value": float(pval)})
-        except Exception:
-            continue
-
-    gdf = gpd.GeoDataFrame(rows, geometry=polys, crs="EPSG:4326").sort_values("coverage", ascending=False)
-    Path(out_geojson).parent.mkdir(parents=True, exist_ok=True)
-    gdf.to_file(out_geojson, driver="GeoJSON")
+    # count coverage of k-ring cells: one ring per distinct center, weighted by how many
+    # incidents fall in it; cells as uint64 ids so the tally is np.unique + bincount
+    centers, n_inc = np.unique(h3_index_array(recent["lat"].to_numpy(), recent["lon"].to_numpy(), h3_res),
+                               return_counts=True)
+    rings = [[int(h, 16) for h in h3_k_ring(c, k)] for c in centers]
+    ring_ids = np.fromiter((h for r in rings for h in r), dtype=np.uint64)
+    weights = np.repeat(n_inc, [len(r) for r in rings])
+    uniq, inv = np.unique(ring_ids, return_inverse=True)
+    cov = np.bincount(inv.ravel(), weights=weights).astype(np.int64)
+
+    # polygons: boundaries are decoded for the U distinct cells only, not per ring hit
+    rows = pd.DataFrame({"h3": [format(int(h), "x") for h in uniq], "coverage": cov})
+    rows["window_days"] = int(recent_days)
+    rows["k"] = int(k)
+    rows["p_value"] = float(pval)
+    gdf = gpd.GeoDataFrame(rows, geometry=h3_polygons(rows["h3"]), crs="EPSG:4326") \
+             .sort_values("coverage", ascending=False, kind="stable")
+    write_cells(gdf, out_geojson)
     print(f"[OK] wrote {out_geojson} — cells: {len(gdf):,} (recent_days={recent_days}, k={k})")
     print("Properties per cell: coverage (#recent incidents whose k-ring includes cell), window_days, k, p_value")
     print("Tip: symbolize by coverage, and add a side note showing global p-value.")
@@ -256,6 +338,9 @@ if __name__ == "__main__":
     ap.add_argument("--recent_days", type=int, default=14)
     ap.add_argument("--k", type=int, default=1)
     ap.add_argument("--permutations", type=int, default=500)
+    ap.add_argument("--n_jobs", type=int, default=-1, help="joblib workers for permutations (-1: all cores)")
+    ap.add_argument("--stop_alpha", type=float, default=0.05,
+                    help="stop permuting once p < stop_alpha is certain (Wilson bound); 0 runs all permutations")
     ap.add_argument("--latcol", default=None)
     ap.add_argument("--loncol", default=None)
     ap.add_argument("--datecol", default=None)
@@ -275,6 +360,8 @@ if __name__ == "__main__":
         recent_days=args.recent_days,
         k=args.k,
         permutations=args.permutations,
+        n_jobs=args.n_jobs,
+        stop_alpha=args.stop_alpha,
         latcol=args.latcol,
         loncol=args.loncol,
         datecol=args.datecol,
@@ -291,8 +378,10 @@ Results:
     n incidents: 9,954 (lookback=90d, filter=None)
     thresholds: distance≤250.0 m, time≤14 d
     observed pairs: 27,362
-    null mean±sd: 7912.4 ± 87.9 (R=500)
-    Monte-Carlo p-value: 0.00200 | z≈221.17
+    null mean±sd: ≈7912 ± 88 (R=128 of 500, stopped early)
+    Monte-Carlo p-value: 0.00775 | z≈221
+    (with --stop_alpha 0 all 500 run: R=500, p=0.00200, z≈221.17; no permutation
+     reaches the observed count, so p = 1/(R+1) either way)
     [OK] wrote geojson/near_repeat.geojson — cells: 3,455 (recent_days=14, k=1)
     Properties per cell: coverage (#recent incidents whose k-ring includes cell), window_days, k, p_value
     Tip: symbolize by coverage, and add a side note showing global p-value.
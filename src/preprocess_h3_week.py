@@ -29,9 +29,12 @@ from pathlib import Path
 import pandas as pd
 
 try:
-    import h3  # conda install -c conda-forge h3-py
+    import pyarrow as pa
+    import pyarrow.parquet as pq  # multi-threaded groupby and parquet writer
 except ImportError:
-    raise SystemExit("Missing h3-py. Install with: conda install -c conda-forge h3-py")
+    raise SystemExit("Missing pyarrow. Install with: conda install -c conda-forge pyarrow")
+
+from incidents import filter_offence, h3_index_array, parse_date_plus_time, read_csv_columns
 
 # ---- candidate name pools (compare in lowercase) ----
 CANDS = {
@@ -53,14 +56,6 @@ CANDS = {
     ],
 }
 
-# --- H3 v3/v4 compatibility ---
-def h3_index(lat, lon, res):
-    # v3: geo_to_h3; v4: latlng_to_cell
-    if hasattr(h3, "geo_to_h3"):
-        return h3.geo_to_h3(lat, lon, res)
-    else:
-        return h3.latlng_to_cell(lat, lon, res)
-
 def pick(colnames, pool):
     """Pick the first matching column from a list of candidates (case-insensitive)."""
     low = {c.lower(): c for c in colnames}
@@ -91,8 +86,7 @@ def combine_date_time(df, c_date, c_time):
         dt = base + pd.to_timedelta(hour, unit="h")
         return dt
     else:
-        comb = df[c_date].astype(str) + " " + df[c_time].astype(str)
-        return to_tz_toronto(comb)
+        return to_tz_toronto(parse_date_plus_time(df[c_date], df[c_time]))
 
 def week_start_monday(ts):
     """Get week start (Monday) in Toronto local time."""
@@ -102,8 +96,7 @@ def week_start_monday(ts):
 
 def main(csv_path, out_parquet, h3_res=9, offence_filter=None,
          latcol=None, loncol=None, datecol=None, timecol=None, offencecol=None):
-    df = pd.read_csv(csv_path, low_memory=False)
-    cols = list(df.columns)
+    cols = list(pd.read_csv(csv_path, nrows=0).columns)
 
     # Allow explicit CLI overrides; otherwise auto-detect
     c_lat = latcol or pick(cols, CANDS["lat"])
@@ -120,9 +113,9 @@ def main(csv_path, out_parquet, h3_res=9, offence_filter=None,
             "Try: --latcol LAT_WGS84 --loncol LONG_WGS84 --datecol OCC_DATE --timecol OCC_HOUR"
         )
 
-    # Keep only the columns we actually use
+    # Read only the columns we actually use
     keep = [c for c in [c_lat, c_lon, c_date, c_time, c_off] if c]
-    df = df[keep].copy()
+    df = read_csv_columns(csv_path, keep, str_columns=[c_date])
 
     # Lat/Lon → numeric
     df["lat"] = pd.to_numeric(df[c_lat], errors="coerce")
@@ -131,25 +124,30 @@ def main(csv_path, out_parquet, h3_res=9, offence_filter=None,
 
     # Optional offence filter
     if offence_filter and c_off:
-        df = df[df[c_off].astype(str).str.contains(offence_filter, case=False, na=False)]
+        df = filter_offence(df, c_off, offence_filter)
 
     # Build a tz-aware datetime
     df["dt"] = combine_date_time(df, c_date, c_time)
     df = df.dropna(subset=["dt"])
 
     # H3 index
-    df["h3"] = [h3_index(lat, lon, h3_res) for lat, lon in zip(df["lat"], df["lon"])]
+    df["h3"] = h3_index_array(df["lat"].to_numpy(), df["lon"].to_numpy(), h3_res)
 
     # Week start (Monday)
     df["week_start"] = week_start_monday(df["dt"])
 
-    # Aggregate to (h3 × week)
-    agg = (df.groupby(["h3", "week_start"], as_index=False)
-             .size()
-             .rename(columns={"size": "count"}))
-
+    # Aggregate to (h3 × week), sorted by week and written with modest row groups,
+    # so readers filtering on week_start can skip whole row groups from the
+    # parquet min/max statistics
     Path(out_parquet).parent.mkdir(parents=True, exist_ok=True)
-    agg.to_parquet(out_parquet, index=False)
+    # multi-threaded Arrow groupby, written straight from the Arrow table
+    agg = (pa.Table.from_pandas(df[["h3", "week_start"]], preserve_index=False)
+             .group_by(["h3", "week_start"])
+             .aggregate([([], "count_all")])
+             .select(["h3", "week_start", "count_all"])  # by name: output order isn't guaranteed
+             .rename_columns(["h3", "week_start", "count"])
+             .sort_by([("week_start", "ascending"), ("h3", "ascending")]))
+    pq.write_table(agg, out_parquet, row_group_size=64_000, compression="zstd")
     print(f"[OK] wrote {out_parquet} — rows: {len(agg):,}")
     print("Picked columns ->",
           {"lat": c_lat, "lon": c_lon, "date": c_date, "time": c_time, "offence": c_off})